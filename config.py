@@ -0,0 +1,20 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file once per process; other modules import the values from here
+load_dotenv()
+
+# --- Configuration ---
+GHL_API_BASE_URL = "https://services.leadconnectorhq.com"
+GHL_ACCESS_TOKEN = os.getenv("GHL_ACCESS_TOKEN")
+GHL_CLIENT_ID = os.getenv("GHL_CLIENT_ID")
+GHL_CLIENT_SECRET = os.getenv("GHL_CLIENT_SECRET")
+GHL_REFRESH_TOKEN = os.getenv("GHL_REFRESH_TOKEN") # Used when .tokens.json has no refresh token
+GHL_TOKENS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tokens.json") # Shared with ghl-oauth-server.js
+GHL_LOCATION_ID = os.getenv("GHL_LOCATION_ID")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+DEFAULT_PIPELINE_NAME = "Client Software Development Pipeline" # Set your default pipeline here
+PIPELINE_CACHE_TTL = 300 # Seconds to reuse the fetched pipeline list
+QUERY_JOB_TTL = 600 # Seconds to keep a finished background query that was never polled
+GHL_REQUEST_TIMEOUT = (5, 30) # (connect, read) seconds for each GHL request, so a stalled socket can't pin a worker
+GEMINI_REQUEST_TIMEOUT = 30 # Seconds to wait for a Gemini interpretation
@@ -1,18 +1,41 @@
 import os
+import re
+import tempfile
+import time
+import threading
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
-from dotenv import load_dotenv
 import json
 
-# Load environment variables from .env file
-load_dotenv()
+# orjson parses the large opportunity payloads several times faster; fall back to the stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-# --- Configuration ---
-GHL_API_BASE_URL = "https://services.leadconnectorhq.com"
-GHL_ACCESS_TOKEN = os.getenv("GHL_ACCESS_TOKEN")
-GHL_LOCATION_ID = os.getenv("GHL_LOCATION_ID")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-DEFAULT_PIPELINE_NAME = "Client Software Development Pipeline" # Set your default pipeline here
+from config import (
+    GHL_API_BASE_URL,
+    GHL_ACCESS_TOKEN,
+    GHL_CLIENT_ID,
+    GHL_CLIENT_SECRET,
+    GHL_REFRESH_TOKEN,
+    GHL_TOKENS_FILE,
+    GHL_LOCATION_ID,
+    GEMINI_API_KEY,
+    DEFAULT_PIPELINE_NAME,
+    PIPELINE_CACHE_TTL,
+    QUERY_JOB_TTL,
+    GHL_REQUEST_TIMEOUT,
+    GEMINI_REQUEST_TIMEOUT,
+)
 
 # Configure the Gemini API
 if GEMINI_API_KEY:
@@ -23,74 +46,213 @@ else:
     print("Error: GEMINI_API_KEY not found in .env file.")
     exit()
 
-# --- GHL API Functions ---
+# Build the Gemini model once; None means interpretation is unavailable
+try:
+    _GEMINI_MODEL = genai.GenerativeModel('gemini-2.5-flash')
+except Exception as e:
+    print(f"Error: Gemini model not available: {e}")
+    _GEMINI_MODEL = None
 
-def get_all_pipelines():
-    """Fetches all pipelines for the configured location."""
-    headers = {
-        "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
-        "Version": "2021-07-28",
-        "Accept": "application/json"
+# Shared HTTP session for GHL so repeat calls reuse pooled keep-alive connections
+_session = requests.Session()
+# Authorization is set once the saved tokens have been read, below the auth functions
+_session.headers.update({
+    "Version": "2021-07-28",
+    "Accept": "application/json"
+})
+_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Fixed request parts, built once instead of per call
+_TOKEN_URL = f"{GHL_API_BASE_URL}/oauth/token"
+_PIPELINES_URL = f"{GHL_API_BASE_URL}/opportunities/pipelines"
+_SEARCH_URL = f"{GHL_API_BASE_URL}/opportunities/search"
+_PIPELINES_PARAMS = {"locationId": GHL_LOCATION_ID}
+_SEARCH_BASE_PARAMS = {"location_id": GHL_LOCATION_ID, "getTasks": "true"}
+
+# Worker pool for overlapping independent network calls within a query
+_executor = ThreadPoolExecutor(max_workers=4)
+
+# Separate pool for whole queries run in the background, so they never starve _executor
+_query_executor = ThreadPoolExecutor(max_workers=8)
+_query_jobs = {} # {job_id: {"future": future, "finished_at": epoch seconds or None}}
+_query_jobs_lock = threading.Lock()
+
+# Pipelines rarely change, so keep them per location: {location_id: (expires_at, pipelines, name_to_id)}
+_pipeline_cache = {}
+
+# Serializes token refreshes so concurrent 401s trigger a single refresh
+_token_lock = threading.Lock()
+
+# --- GHL Auth Functions ---
+
+def _load_tokens():
+    """Returns the token data saved in .tokens.json for GHL_LOCATION_ID, or {} if missing, unreadable or for another location."""
+    try:
+        with open(GHL_TOKENS_FILE) as f:
+            tokens = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(tokens, dict):
+        return {}
+    # ghl-oauth-server.js saves whichever location authorized last; its tokens don't work for ours
+    if tokens.get("location_id") and tokens["location_id"] != GHL_LOCATION_ID:
+        return {}
+    return tokens
+
+def _load_refresh_token():
+    """Returns the current refresh token from .tokens.json, falling back to GHL_REFRESH_TOKEN."""
+    return _load_tokens().get("refresh_token") or GHL_REFRESH_TOKEN
+
+def _saved_access_token():
+    """Returns the access token from .tokens.json if it hasn't expired yet, else None."""
+    tokens = _load_tokens()
+    expires_at = tokens.get("expires_at") # Milliseconds, as written by ghl-oauth-server.js
+    if tokens.get("access_token") and isinstance(expires_at, (int, float)) and expires_at > time.time() * 1000:
+        return tokens["access_token"]
+    return None
+
+def _adopt_saved_token(stale_authorization):
+    """Switches the session to the saved access token if another process refreshed it. Returns True if adopted."""
+    access_token = _saved_access_token()
+    if access_token and f"Bearer {access_token}" != stale_authorization:
+        _session.headers["Authorization"] = f"Bearer {access_token}"
+        return True
+    return False
+
+def _save_tokens(token_data, used_refresh_token):
+    """Persists refreshed tokens to .tokens.json in the format ghl-oauth-server.js writes."""
+    expires_in = token_data.get("expires_in", 0)
+    tokens = {
+        "access_token": token_data["access_token"],
+        # Keep the token we just used if GHL didn't rotate it
+        "refresh_token": token_data.get("refresh_token") or used_refresh_token,
+        "expires_in": expires_in,
+        "location_id": token_data.get("locationId", GHL_LOCATION_ID),
+        "expires_at": int((time.time() + expires_in) * 1000)
     }
-    pipelines_url = f"{GHL_API_BASE_URL}/opportunities/pipelines"
-    params = {"locationId": GHL_LOCATION_ID}
+    # Write a temp file and swap it in, so readers in other processes never see a partial file
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(GHL_TOKENS_FILE), prefix=".tokens.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f, indent=2)
+        os.replace(temp_path, GHL_TOKENS_FILE)
+    except OSError as e:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        # In a web context, log this error
+        print(f"Warning: Could not save tokens to {GHL_TOKENS_FILE}: {e}")
+
+def _refresh_access_token(stale_authorization):
+    """Exchanges the refresh token for a new access token. Returns True if the session now holds a fresh token."""
+    with _token_lock:
+        # Another thread already refreshed while we waited
+        if _session.headers.get("Authorization") != stale_authorization:
+            return True
+        # Another process already refreshed and saved a new token; refreshing again would waste a rotation
+        if _adopt_saved_token(stale_authorization):
+            return True
+
+        refresh_token = _load_refresh_token()
+        if not (refresh_token and GHL_CLIENT_ID and GHL_CLIENT_SECRET):
+            print("Error: Cannot refresh GHL access token; refresh token or client credentials missing.")
+            return False
+
+        token_payload = {
+            "client_id": GHL_CLIENT_ID,
+            "client_secret": GHL_CLIENT_SECRET,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token
+        }
+        try:
+            # Drop the expired bearer token from this request only
+            response = _session.post(_TOKEN_URL, data=token_payload, headers={"Authorization": None}, timeout=GHL_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            token_data = _json_loads(response.content)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # A worker that refreshed first invalidates our refresh token, but its new access token is on disk
+            if _adopt_saved_token(stale_authorization):
+                return True
+            # In a web context, log this error
+            print(f"Error refreshing GHL access token: {e}")
+            return False
+
+        # GHL rotates refresh tokens, so persist the new pair before using it
+        _save_tokens(token_data, refresh_token)
+        _session.headers["Authorization"] = f"Bearer {token_data['access_token']}"
+        return True
+
+def _ghl_get(url, params):
+    """GETs a GHL endpoint on the shared session, refreshing the access token and retrying once on 401."""
+    authorization = _session.headers.get("Authorization")
+    response = _session.get(url, params=params, timeout=GHL_REQUEST_TIMEOUT)
+    if response.status_code == 401 and _refresh_access_token(authorization):
+        response = _session.get(url, params=params, timeout=GHL_REQUEST_TIMEOUT)
+    return response
+
+# Prefer the unexpired token last saved by ghl-oauth-server.js or a refresh over the one in .env
+_session.headers["Authorization"] = f"Bearer {_saved_access_token() or GHL_ACCESS_TOKEN}"
+
+# --- GHL API Functions ---
+
+def get_pipeline_index():
+    """Returns (pipelines, {lowercase name: id}) for the location, cached for PIPELINE_CACHE_TTL seconds; None on failure."""
+    cached = _pipeline_cache.get(GHL_LOCATION_ID)
+    if cached and time.time() < cached[0]:
+        return cached[1], cached[2]
 
     try:
-        response = requests.get(pipelines_url, headers=headers, params=params)
+        response = _ghl_get(_PIPELINES_URL, _PIPELINES_PARAMS)
         response.raise_for_status()
-        return response.json().get("pipelines", [])
-    except requests.exceptions.RequestException as e:
+        pipelines = _json_loads(response.content).get("pipelines", [])
+        pipeline_name_to_id = {p["name"].lower(): p["id"] for p in pipelines}
+        _pipeline_cache[GHL_LOCATION_ID] = (time.time() + PIPELINE_CACHE_TTL, pipelines, pipeline_name_to_id)
+        return pipelines, pipeline_name_to_id
+    except (requests.exceptions.RequestException, ValueError) as e:
         # In a web context, log this error, don't print directly to stdout
         print(f"Error fetching pipelines: {e}") 
         if hasattr(e, 'response') and e.response:
             print(f"Response Body: {e.response.text}")
         return None
 
+def get_all_pipelines():
+    """Fetches all pipelines for the configured location, cached for PIPELINE_CACHE_TTL seconds."""
+    index = get_pipeline_index()
+    return index[0] if index else None
+
 def get_ghl_opportunities(pipeline_id, status):
     """Fetches opportunities and their tasks from GHL for a specific pipeline."""
-    headers = {
-        "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
-        "Version": "2021-07-28",
-        "Accept": "application/json"
-    }
-    
-    params = {
-        "location_id": GHL_LOCATION_ID,
-        "getTasks": "true",
-        "pipeline_id": pipeline_id,
-        "status": status
-    }
-    
-    search_url = f"{GHL_API_BASE_URL}/opportunities/search"
+    params = {**_SEARCH_BASE_PARAMS, "pipeline_id": pipeline_id, "status": status}
     
     # In a web context, log this, don't print directly
     print(f"Querying GHL API for pipeline {pipeline_id}...")
 
     try:
-        response = requests.get(search_url, headers=headers, params=params)
+        response = _ghl_get(_SEARCH_URL, params)
         response.raise_for_status()
-        return response.json().get("opportunities", [])
-    except requests.exceptions.RequestException as e:
+        return _json_loads(response.content).get("opportunities", [])
+    except (requests.exceptions.RequestException, ValueError) as e:
         # In a web context, log this error
         print(f"Error fetching data from GHL: {e}")
         if hasattr(e, 'response') and e.response:
             print(f"Response Body: {e.response.text}")
+        if getattr(e, 'response', None) is not None and e.response.status_code == 404:
+            # The pipeline may have been removed; drop the cached list so the next query refetches it
+            _pipeline_cache.pop(GHL_LOCATION_ID, None)
         return []
 
 # --- Gemini NLP Functions ---
 
-def get_interpretation_from_gemini(query):
-    """Uses Gemini to interpret a natural language query and return structured filters."""
-    if not genai.get_model("models/gemini-2.5-flash"):
-        # In a web context, log this error
-        print("Error: Gemini model not available.")
-        return None
-        
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    
-    prompt = f"""
+# Prompt text around the user query, kept as constants so each call is a plain concatenation
+_PROMPT_PREFIX = """
     You are an intelligent assistant. Your task is to interpret a user's query about GoHighLevel opportunities and extract filtering criteria.
-    The user's query is: "{query}"
+    The user's query is: \""""
+
+_PROMPT_SUFFIX = """\"
     
     Based on this query, identify the following optional keys: 'opportunity_name' (can be a string or a list of strings), 'pipeline_name', and 'task_limit' (an integer).
     If the user asks for 'a task' or 'one task', set task_limit to 1.
@@ -99,66 +261,89 @@ def get_interpretation_from_gemini(query):
     Return the result as a JSON object. Here are some examples:
     
     Query: "a task for project techceo"
-    Response: {{'opportunity_name': 'Project TechCEO', 'task_limit': 1}}
+    Response: {'opportunity_name': 'Project TechCEO', 'task_limit': 1}
 
     Query: "tasks for project A and project B"
-    Response: {{'opportunity_name': ['Project A', 'Project B']}}
+    Response: {'opportunity_name': ['Project A', 'Project B']}
 
     Query: "show me 3 tasks for project voice agent in the internal pipeline"
-    Response: {{'pipeline_name': 'Internal Pipeline', 'opportunity_name': 'Project Voice Agent', 'task_limit': 3}}
+    Response: {'pipeline_name': 'Internal Pipeline', 'opportunity_name': 'Project Voice Agent', 'task_limit': 3}
     
     Query: "show me all tasks in the client pipeline"
-    Response: {{'pipeline_name': 'Client Pipeline'}}
+    Response: {'pipeline_name': 'Client Pipeline'}
 
-    If you cannot determine any criteria, return an empty JSON object: {{}}
+    If you cannot determine any criteria, return an empty JSON object: {}
     """
-    
+
+def get_interpretation_from_gemini(query):
+    """Uses Gemini to interpret a natural language query and return structured filters, or None on failure."""
+    if _GEMINI_MODEL is None:
+        # In a web context, log this error
+        print("Error: Gemini model not available.")
+        return None
+
     try:
-        response = model.generate_content(prompt)
-        json_str = response.text.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(json_str)
+        # Identical queries reuse the cached Gemini output; parse per call so callers get a fresh dict
+        interp = _json_loads(_generate_interpretation(query.strip().lower()))
     except Exception as e:
         # In a web context, log this error
         print(f"Error interpreting query with Gemini: {e}")
-        return {{}}
+        return None
 
-# --- Main Execution Logic (now a function to be called by API) ---
+    # Anything other than a JSON object carries no usable criteria
+    return interp if isinstance(interp, dict) else {}
 
-def process_query(user_query):
-    output_lines = []
+@lru_cache(maxsize=512)
+def _generate_interpretation(query):
+    """Asks Gemini for the filters of a normalized query and returns the JSON text. Errors propagate so they aren't cached."""
+    prompt = _PROMPT_PREFIX + query + _PROMPT_SUFFIX
+    
+    response = _GEMINI_MODEL.generate_content(prompt, request_options={"timeout": GEMINI_REQUEST_TIMEOUT})
+    json_str = response.text.strip().replace("```json", "").replace("```", "").strip()
+    _json_loads(json_str) # Reject malformed output before it is cached
+    return json_str
+
+# --- Main Execution Logic (now a function to be called by API) ---
 
+def process_query_stream(user_query):
+    """Yields newline-terminated report lines, so callers can stream output before GHL calls finish."""
     if not user_query:
-        output_lines.append("No query provided.")
-        return "\n".join(output_lines)
+        yield "No query provided.\n"
+        return
+
+    # The pipeline list doesn't depend on the query, so fetch it while Gemini runs
+    pipelines_future = _executor.submit(get_pipeline_index)
 
     # 1. Get structured filters from Gemini
     interp = get_interpretation_from_gemini(user_query)
-    output_lines.append(f"Gemini interpretation: {interp}")
+    if interp is None:
+        yield "Error: Could not interpret the query with Gemini.\n"
+        return
+    yield f"Gemini interpretation: {interp}\n"
 
     # 2. Determine the pipeline to use (default or from query)
     if interp.get("pipeline_name"):
         pipeline_name = interp["pipeline_name"]
     else:
-        output_lines.append(f"No pipeline specified in query, using default: '{DEFAULT_PIPELINE_NAME}'")
+        yield f"No pipeline specified in query, using default: '{DEFAULT_PIPELINE_NAME}'\n"
         pipeline_name = DEFAULT_PIPELINE_NAME
 
     # 3. Get all available pipelines from GHL to find the ID
-    output_lines.append("Fetching all available pipelines...")
-    all_pipelines = get_all_pipelines()
-    if all_pipelines is None:
-        output_lines.append("Failed to fetch pipelines.")
-        return "\n".join(output_lines)
+    yield "Fetching all available pipelines...\n"
+    pipeline_index = pipelines_future.result()
+    if pipeline_index is None:
+        yield "Failed to fetch pipelines.\n"
+        return
     
-    pipeline_name_to_id = {p["name"].lower(): p["id"] for p in all_pipelines}
+    all_pipelines, pipeline_name_to_id = pipeline_index
     pipeline_id = pipeline_name_to_id.get(pipeline_name.lower())
 
     if not pipeline_id:
-        output_lines.append(f"Error: Could not find a pipeline with the name '{pipeline_name}'.")
-        available_names = [p.get('name') for p in all_pipelines]
-        output_lines.append(f"Available pipelines are: {available_names}")
-        return "\n".join(output_lines)
+        yield f"Error: Could not find a pipeline with the name '{pipeline_name}'.\n"
+        yield "Available pipelines are: " + ", ".join(p.get('name', '?') for p in all_pipelines) + "\n"
+        return
 
-    output_lines.append(f"Found Pipeline ID for '{pipeline_name}': {pipeline_id}")
+    yield f"Found Pipeline ID for '{pipeline_name}': {pipeline_id}\n"
     status = interp.get("status", "open")
     opportunities = get_ghl_opportunities(pipeline_id, status)
 
@@ -168,43 +353,97 @@ def process_query(user_query):
         if not isinstance(opp_names, list):
             opp_names = [opp_names]
         
-        lowercase_opp_names = [name.lower() for name in opp_names]
-        output_lines.append(f"Filtering for opportunities matching: {opp_names}...")
+        # One alternation regex checks every requested name in a single scan per opportunity
+        opp_name_pattern = re.compile("|".join(re.escape(name.lower()) for name in opp_names))
+        yield f"Filtering for opportunities matching: {opp_names}...\n"
         
-        filtered_opps = [o for o in opportunities if any(name in o.get("name", "").lower() for name in lowercase_opp_names)]
+        filtered_opps = [o for o in opportunities if opp_name_pattern.search(o.get("name", "").lower())]
 
         opportunities = filtered_opps
         if not opportunities:
-            output_lines.append(f"Could not find any opportunity matching your criteria.")
-            return "\n".join(output_lines)
+            yield f"Could not find any opportunity matching your criteria.\n"
+            return
     else:
-        output_lines.append("No specific opportunity requested, showing tasks for all opportunities in the pipeline.")
+        yield "No specific opportunity requested, showing tasks for all opportunities in the pipeline.\n"
 
     # 5. Process and display tasks
-    output_lines.append("\n--- Tasks from Opportunities ---")
+    yield "\n--- Tasks from Opportunities ---\n"
     task_found = False
     task_limit = interp.get("task_limit")
+    # Gemini may return a non-positive or non-integer limit; show all tasks in that case
+    if not (isinstance(task_limit, int) and task_limit > 0):
+        task_limit = None
     
     for opp in opportunities:
         if opp.get("tasks"):
-            incomplete_tasks = [t for t in opp["tasks"] if not t.get("completed")]
+            incomplete_tasks = (t for t in opp["tasks"] if not t.get("completed"))
+            # Stop scanning once task_limit incomplete tasks are found
+            tasks_to_show = list(islice(incomplete_tasks, task_limit) if task_limit else incomplete_tasks)
             
-            if not incomplete_tasks:
+            if not tasks_to_show:
                 continue
 
             task_found = True
-            output_lines.append(f"\nOpportunity: {opp.get('name', 'N/A')} (Pipeline: {opp.get('pipelineName', 'N/A')})")
+            yield f"\nOpportunity: {opp.get('name', 'N/A')} (Pipeline: {opp.get('pipelineName', 'N/A')})\n"
             
-            tasks_to_show = incomplete_tasks
             if task_limit:
-                output_lines.append(f"(Showing up to {task_limit} task(s) as requested)")
-                tasks_to_show = incomplete_tasks[:task_limit]
+                yield f"(Showing up to {task_limit} task(s) as requested)\n"
             
             for task in tasks_to_show:
-                output_lines.append(f"  - [ ] Task: {task.get('title', 'No Title')}")
-                output_lines.append(f"    > Due: {task.get('dueDate', 'N/A')}")
+                yield f"  - [ ] Task: {task.get('title', 'No Title')}\n"
+                yield f"    > Due: {task.get('dueDate', 'N/A')}\n"
         
     if not task_found:
-        output_lines.append("No incomplete tasks found for the given criteria.")
+        yield "No incomplete tasks found for the given criteria.\n"
+
+def process_query(user_query):
+    """Runs a query and returns the full report as a single string."""
+    return "".join(process_query_stream(user_query)).removesuffix("\n")
+
+async def process_query_async(user_query):
+    """Runs process_query in a worker thread so async views don't block their event loop."""
+    return await asyncio.to_thread(process_query, user_query)
 
-    return "\n".join(output_lines)
+def _prune_query_jobs():
+    """Drops jobs that finished more than QUERY_JOB_TTL seconds ago and were never polled. Caller holds _query_jobs_lock."""
+    cutoff = time.time() - QUERY_JOB_TTL
+    expired = [job_id for job_id, job in _query_jobs.items() if job["finished_at"] is not None and job["finished_at"] < cutoff]
+    for job_id in expired:
+        del _query_jobs[job_id]
+
+def _mark_query_job_finished(job_id):
+    """Records when a job finished, so its TTL starts then rather than at submit time."""
+    with _query_jobs_lock:
+        job = _query_jobs.get(job_id)
+        if job is not None:
+            job["finished_at"] = time.time()
+
+def submit_query(user_query):
+    """Starts process_query in the background and returns a job id to poll with get_query_result."""
+    job_id = uuid.uuid4().hex
+    future = _query_executor.submit(process_query, user_query)
+    with _query_jobs_lock:
+        _prune_query_jobs()
+        _query_jobs[job_id] = {"future": future, "finished_at": None}
+    # Registered after the entry exists; runs right away here if the job already finished
+    future.add_done_callback(lambda _: _mark_query_job_finished(job_id))
+    return job_id
+
+def get_query_result(job_id):
+    """Returns the job's status dict, or None for an unknown id. Finished jobs are removed once read."""
+    with _query_jobs_lock:
+        _prune_query_jobs()
+        job = _query_jobs.get(job_id)
+        if job is None:
+            return None
+        if not job["future"].done():
+            return {"status": "pending"}
+        # Only one poller can claim a finished job; later polls see an unknown id
+        future = _query_jobs.pop(job_id)["future"]
+
+    try:
+        return {"status": "done", "result": future.result()}
+    except Exception as e:
+        # In a web context, log this error
+        print(f"Error processing query job {job_id}: {e}")
+        return {"status": "error", "error": str(e)}